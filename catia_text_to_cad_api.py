@@ -6,9 +6,10 @@ It connects to a running CATIA session via COM and acts as an "Engineering Agent
 
 PREREQUISITES:
 1. CATIA 3DExperience (V6) must be running.
-2. Python 3.x installed.
+2. Python 3.9+ installed (uses `ast.unparse` and `Executor.shutdown(cancel_futures=...)`).
 3. Libraries: 
    - `pip install pywin32 requests`
+   - Optional: `pip install orjson` for faster JSON handling.
    - `win32com.client` must be able to dispatch "CATIA.Application".
 4. DeepSeek API Key:
    - You must have a valid API Key from https://platform.deepseek.com/
@@ -16,159 +17,554 @@ PREREQUISITES:
 
 USAGE:
 Run the script in a terminal: `python catia_text_to_cad_api.py`
+Set CATIA_DEBUG=1 to print full tracebacks when generated code fails.
 Type natural language commands like:
 - "Create only a point at 10,20,30"
 - "Create a cylinder radius 50 thickness 20 on XY plane"
+Repeated commands are answered from a local cache (~/.catia_agent_cache).
+Prefix a command with "!nocache" to force a fresh answer, e.g. "!nocache Create only a point at 0,0,0".
 
 Author: [Your Name / Organization]
 """
 
 import win32com.client
 import requests
+from requests.adapters import HTTPAdapter
+import ast
+import functools
+import hashlib
+import io
 import json
+import math
+import os
 import re
+import shelve
 import sys
-import traceback
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Final, Optional
+
+try:
+    import orjson # Optional: faster JSON encode/decode
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    _json_loads = json.loads
 
 # --- CONFIG ---
 # ⚠️ REPLACE WITH YOUR OWN API KEY
 API_KEY = "YOUR_API_KEY_HERE"  
 API_URL = "https://api.deepseek.com/chat/completions"
+MODEL = "deepseek-chat"
+DEBUG = bool(os.environ.get("CATIA_DEBUG")) # Set CATIA_DEBUG=1 for full tracebacks
+SIMPLE_MODEL = "deepseek-chat" # Used for single primitives; point at a cheaper model if available
+HEADERS = {"Content-Type": "application/json", "Authorization": f"Bearer {API_KEY}"}
+
+# --- HTTP SESSION ---
+# Reused across commands so the TLS connection to DeepSeek is only set up once.
+_SESSION = requests.Session()
+_SESSION.headers.update(HEADERS)
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+# --- CONNECTION KEEP-ALIVE ---
+# While the user is typing, a background thread pings the cheap /models
+# endpoint so the pooled connection doesn't go cold between commands.
+MODELS_URL = API_URL.replace("/chat/completions", "/models")
+KEEPALIVE_INTERVAL = 45 # seconds
+_api_busy = threading.Event() # Set while a real request is in flight
+_stop_keepalive = threading.Event()
+_active_response = None # Streaming response of the current call, for aborting on Ctrl+C
+
+# --- RESPONSE CACHE ---
+# Repeated prompts are answered locally instead of hitting the API again.
+# Prefix a command with "!nocache" to force a fresh generation.
+CACHE_PATH = os.path.expanduser("~/.catia_agent_cache")
+NOCACHE_PREFIX = "!nocache"
+_MEMORY_CACHE_SIZE = 128
+_memory_cache = OrderedDict()
+
+# --- RESPONSE PARSING ---
+# Plain str.find scan instead of a DOTALL regex: linear even on malformed
+# responses with many unclosed fences.
+_FENCE_OPEN = "```python"
+_FENCE_CLOSE = "```"
+_SSE_PREFIX = b"data: "
+_SSE_DONE = b"[DONE]"
+_TRUNCATED = object() # read_streamed_content result for answers cut off by max_tokens
+_FALLBACK_TOKENS = ("hsf =", "catia.")
 
 # --- SYSTEM PROMPT ---
-SYSTEM_PROMPT = """You are an expert CATIA V6 Automation Engineer using Python and pywin32.
-Your task is to generate executable Python code to create geometry (Wireframe OR Solids) in CATIA.
-
-CONTEXT:
-- The script PRE-DEFINES these variables for you:
-  - `catia`: The application object
-  - `editor`: Active editor
-  - `part`: Active part
-  - `hsf`: HybridShapeFactory
-  - `sf`: ShapeFactory
-  - `bodies`: Part.Bodies
-  - `selection`: Editor.Selection
+# DeepSeek caches repeated prompt prefixes server-side (context caching), which
+# skips prefill for everything up to the first differing token. Keep these
+# prompts byte-stable: never interpolate runtime data (dates, names, part info)
+# into them. Runtime context belongs in the user message.
+# Core rules, sent first with every request.
+SYSTEM_PROMPT: Final[str] = """You are an expert CATIA V6 Automation Engineer using Python and pywin32.
+Generate executable Python code that creates geometry (Wireframe OR Solids) in the active CATIA part.
+
+PRE-DEFINED (do not redefine): `catia`, `editor`, `part`, `hsf` (HybridShapeFactory), `sf` (ShapeFactory), `bodies` (Part.Bodies), `selection` (Editor.Selection), `math`.
+HELPERS (use them, DO NOT use `Item("...")` manually):
+- `hb = require_geoset(part, "AI_Generated")`
+- `body = require_body(part, "PartBody")`
+- `ref = get_top_face(pad)` -> Reference to the top planar face of a Pad (prints debug info, CHECK IT).
 
 RULES:
 1. Output ONLY valid Python code inside ```python``` blocks.
-2. NO NEED to redefine `part`, `hsf`, etc. They are available.
-3. For SOLIDS (Pads/Pockets), you MUST create a Sketch first.
-3. ALWAYS use `Reference` objects for inputs. `part.CreateReferenceFromObject(obj)`
-4. For Sketches: 
-   - Get `part.MainBody` or a Body.
-   - `sk = body.Sketches.Add(ref_plane)`
-   - `o2D = sk.OpenEdition()`, create geometry, `sk.CloseEdition()`.
-
-SAFE RETRIEVAL RULE:
-- **USE HELPERS** provided by the script:
-  - `hb = require_geoset(part, "AI_Generated")`
-  - `body = require_body(part, "PartBody")`
-- DO NOT use `Item("...")` manually.
-
-SOLID STACKING RULE (The "Golden Rule" for Pads):
-- When creating a solid on top of another solid:
-  - **DO NOT** create offset planes for the sketch support. (AddNewPad fails on datum planes).
-  - **ALWAYS** use the PLANAR FACE of the existing solid.
-  - **PATTERN:**
-    ```python
-    # 1. Get reference to the face (e.g. XY plane OR Top Face of previous Pad)
-    ref_face = part.CreateReferenceFromObject(part.OriginElements.PlaneXY)
-    
-    # 2. Sketch on that face
-    sk = body.Sketches.Add(ref_face)
-    ...draw...
-    part.Update()
-    
-    # 3. Create Pad
-    pad = sf.AddNewPad(sk, 20.0)
-    part.Update()
-    ```
-- **CRITICAL:** Before creating any SOLID feature (Pad), ensure:
-  - `part.InWorkObject = body`
-  - `part.Update()`
-
-HELPER: `get_top_face(pad)` will be injected to help you.
-- It prints debug info. CHECK IT.
-
-TRICK FOR SOLIDS (The "Flange" pattern):
+2. ALWAYS use `Reference` objects for inputs: `part.CreateReferenceFromObject(obj)`.
+3. SOLIDS (Pads/Pockets) need a Sketch first:
+   - `body = part.MainBody` (guaranteed to exist), then `part.InWorkObject = body`.
+   - `sk = body.Sketches.Add(ref)`, `f2d = sk.Factory2D`, `sk.OpenEdition()`, draw with `f2d`, `sk.CloseEdition()`.
+   - `pad = sf.AddNewPad(sk, height)`.
+4. Call `part.Update()` exactly once, at the very end, unless a following step needs the updated geometry (e.g. `get_top_face`).
+5. Holes: use `sf.AddNewHoleFromPoint(x, y, z, ref_plane, depth)` if possible, OR Sketch+Pocket.
+6. NO `import` statements: everything you need (including `math`) is pre-defined.
+"""
+
+# Only appended for complex solid commands (see _COMPLEX_RE).
+# Appended AFTER the core rules so both variants share the same cached prefix.
+STACKING_PROMPT: Final[str] = """
+STACKED SOLIDS (Pad on top of another solid):
+- Sketch on the PLANAR FACE of the existing solid (`get_top_face`). DO NOT use offset/datum planes, AddNewPad fails on them.
+- Stacked Pads go INWARDS by default: ALWAYS set `pad.DirectionOrientation = 1` (Opposite). `pad.ReverseDirection` is NOT valid.
+
+EXAMPLE (stepped "Flange"):
 ```python
-# CRITICAL: Use MainBody (guaranteed to exist)
 body = part.MainBody
 part.InWorkObject = body
 
-# Base Pad
-ref_xy = part.CreateReferenceFromObject(part.OriginElements.PlaneXY)
-sk1 = body.Sketches.Add(ref_xy)
-
-f2d = sk1.Factory2D
+sk1 = body.Sketches.Add(part.CreateReferenceFromObject(part.OriginElements.PlaneXY))
 sk1.OpenEdition()
-f2d.CreateClosedCircle(0.0, 0.0, 50.0)
+sk1.Factory2D.CreateClosedCircle(0.0, 0.0, 50.0)
 sk1.CloseEdition()
-part.Update()
-
 pad1 = sf.AddNewPad(sk1, 20.0)
-part.Update() # Ensure Pad1 exists
+part.Update() # Needed: get_top_face reads the updated geometry
 
-# Stack on top
-ref_top = get_top_face(pad1) 
-sk2 = body.Sketches.Add(ref_top)
-
-f2d2 = sk2.Factory2D
+sk2 = body.Sketches.Add(get_top_face(pad1))
 sk2.OpenEdition()
-f2d2.CreateClosedCircle(0.0, 0.0, 30.0)
+sk2.Factory2D.CreateClosedCircle(0.0, 0.0, 30.0)
 sk2.CloseEdition()
-part.Update()
-
 pad2 = sf.AddNewPad(sk2, 10.0)
-# CRITICAL: Fix Direction for Stacked Pads
-# 0 = Regular (Into the base), 1 = Opposite (Out/Up)
-# If it goes into the part, set to 1.
-pad2.DirectionOrientation = 1 
+pad2.DirectionOrientation = 1
 part.Update()
 ```
-
-DIRECTION RULE FOR STACKED PADS:
-- When creating a Pad on top of another solid, the default direction is often INWARDS.
-- **ALWAYS** set `pad.DirectionOrientation = 1` (Opposite) to force it outwards/upwards.
-- `pad.ReverseDirection` is NOT valid. Use `DirectionOrientation`.
-
-When user asks for "Holes", simplify by using `sf.AddNewHoleFromPoint(x,y,z, ref_plane, depth)` if possible, OR Sketch+Pocket.
 """
 
-def call_deepseek_for_code(user_prompt):
+# Second turn sent when generated code fails validation.
+REPAIR_PROMPT = """The code above was rejected before execution: {error}
+Return the complete corrected code in a single ```python``` block."""
+
+# Request routing: solids get the full prompt and more tokens, single wireframe
+# primitives a tight budget. Complex keywords win when both match, so
+# "extrude a circle" is still treated as a solid.
+_COMPLEX_RE = re.compile(
+    r"\b(pads?|pockets?|holes?|stack(?:ed|ing)?|on top|flanges?"
+    r"|extrud(?:e|ed|es|ing)|extrusions?|cylinders?|box(?:es)?|solids?|boss(?:es)?)\b",
+    re.IGNORECASE
+)
+_SIMPLE_RE = re.compile(r"\b(points?|lines?|circles?|only a)\b", re.IGNORECASE)
+
+_BASE_PAYLOAD = {
+    "temperature": 0.1, # Keep it deterministic for code
+    "stream": True, # Show tokens as they arrive instead of waiting for the full answer
+    # Stop decoding at the closing fence. Only "\n```\n" is safe here: a bare
+    # "\n```" would also match the opening "\n```python".
+    "stop": ["\n```\n"]
+}
+
+def build_payload_template(base, system_prompt):
+    """Pre-serialise `base` + messages into (prefix, suffix, hasher) around the user content.
+
+    The hasher is seeded with the prefix, so cache keys change whenever the
+    model, options or system prompt do.
+    """
+    marker = "__USER_PROMPT__"
+    # Static system message strictly first, the varying user message last.
+    payload = dict(base, messages=[
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": marker}
+    ])
+    prefix, suffix = _json_dumps(payload).split(_json_dumps(marker))
+    return prefix, suffix, hashlib.blake2b(prefix, digest_size=16)
+
+# Only the user string changes per call, so the static part is encoded once.
+# Generated code rarely needs more than ~300 tokens; stacked solids get more room.
+_ROUTES = {
+    "simple": build_payload_template(dict(_BASE_PAYLOAD, model=SIMPLE_MODEL, max_tokens=256), SYSTEM_PROMPT),
+    "default": build_payload_template(dict(_BASE_PAYLOAD, model=MODEL, max_tokens=512), SYSTEM_PROMPT),
+    "complex": build_payload_template(dict(_BASE_PAYLOAD, model=MODEL, max_tokens=1024), SYSTEM_PROMPT + STACKING_PROMPT)
+}
+
+def _classify(user_prompt):
+    if _COMPLEX_RE.search(user_prompt):
+        return "complex"
+    if _SIMPLE_RE.search(user_prompt):
+        return "simple"
+    return "default"
+
+def select_payload_template(user_prompt):
+    return _ROUTES[_classify(user_prompt)]
+
+# Smallest to largest token budget, used to retry truncated answers.
+_ROUTE_ORDER = ("simple", "default", "complex")
+
+def next_larger_template(template):
+    """Return the route after `template` in _ROUTE_ORDER, or None if it is the largest."""
+    for name, larger in zip(_ROUTE_ORDER, _ROUTE_ORDER[1:]):
+        if _ROUTES[name] is template:
+            return _ROUTES[larger]
+    return None
+
+def call_deepseek_for_code(user_prompt, template=None, followups=()):
     print("   🧠 Thinking (DeepSeek)...")
-    payload = {
-        "model": "deepseek-chat",
-        "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": user_prompt}
-        ],
-        "temperature": 0.1 # Keep it deterministic for code
-    }
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {API_KEY}"}
+    template = template or select_payload_template(user_prompt)
+    prefix, suffix, _ = template
+    if followups:
+        # Splice extra turns after the user message; suffix starts with its closing "}"
+        extra = b"".join(b"," + _json_dumps(msg) for msg in followups)
+        payload = prefix + _json_dumps(user_prompt) + b"}" + extra + suffix[1:]
+    else:
+        payload = prefix + _json_dumps(user_prompt) + suffix
     
+    global _active_response
+    truncated = False
+    _api_busy.set()
     try:
-        resp = requests.post(API_URL, headers=headers, json=payload, timeout=20)
-        if resp.status_code == 200:
-            content = resp.json()["choices"][0]["message"]["content"]
-            return content
-        else:
-            print(f"❌ API Error: {resp.status_code} - {resp.text}")
+        with _SESSION.post(API_URL, data=payload, timeout=20, stream=True) as resp:
+            _active_response = resp
+            if resp.status_code == 200:
+                content = read_streamed_content(resp)
+                if content is not _TRUNCATED:
+                    return content
+                truncated = True
+            else:
+                print(f"❌ API Error: {resp.status_code} - {resp.text}")
     except Exception as e:
-        print(f"❌ Connection Error: {e}")
+        if not _stop_keepalive.is_set(): # Aborted on quit, nothing to report
+            print(f"❌ Connection Error: {e}")
+    finally:
+        _active_response = None
+        _api_busy.clear()
+
+    if truncated:
+        # Routing is a fixed function of the prompt, so give it more room once
+        larger = next_larger_template(template)
+        if larger is not None:
+            print("   ↗ Retrying with a larger token budget...")
+            return call_deepseek_for_code(user_prompt, larger, followups)
     return None
 
+def abort_active_request():
+    """Close the in-flight response so a blocked worker read fails immediately."""
+    resp = _active_response
+    if resp is not None:
+        try:
+            resp.close()
+        except Exception:
+            pass
+
+def _keepalive_loop():
+    # First probe runs immediately so the first real call hits a warm connection
+    while True:
+        if not _api_busy.is_set():
+            try:
+                _SESSION.get(MODELS_URL, timeout=5).close()
+            except Exception:
+                pass # Best effort, the real call reports connection problems
+        if _stop_keepalive.wait(KEEPALIVE_INTERVAL):
+            return
+
+def start_keepalive():
+    thread = threading.Thread(target=_keepalive_loop, name="deepseek-keepalive", daemon=True)
+    thread.start()
+    return thread
+
+def read_streamed_content(resp):
+    """Accumulate SSE `delta` tokens, echoing them, until the python fence closes.
+
+    Returns _TRUNCATED when the code block was cut off by max_tokens.
+    """
+    buf = io.StringIO()
+    opened = closed = done = False
+    finish_reason = None
+    tail = ""
+    # The stream is always read to the end, even once the code block is
+    # complete: an unconsumed body makes requests close the socket instead of
+    # returning the connection to the pool.
+    for line in resp.iter_lines():
+        if done or closed or not line or not line.startswith(_SSE_PREFIX):
+            continue # Blank separators / keep-alive comments / drained tail
+        data = line[len(_SSE_PREFIX):]
+        if data == _SSE_DONE:
+            done = True
+            continue
+        choice = _json_loads(data)["choices"][0]
+        finish_reason = choice.get("finish_reason") or finish_reason
+        delta = choice.get("delta", {}).get("content")
+        if not delta:
+            continue
+        buf.write(delta)
+        sys.stdout.write(delta)
+        sys.stdout.flush()
+
+        # Incremental fence detection: only scan the new chunk plus a short tail
+        window = tail + delta
+        if not opened:
+            idx = window.find(_FENCE_OPEN)
+            if idx != -1:
+                opened = True
+                window = window[idx + len(_FENCE_OPEN):]
+        if opened and _FENCE_CLOSE in window:
+            closed = True # Code block complete, the rest is prose we discard
+            continue
+        tail = window[-(len(_FENCE_OPEN) - 1):]
+    print()
+
+    if opened and not closed:
+        if finish_reason == "length":
+            print("⚠️ Response hit max_tokens, generated code is truncated. Discarding it.")
+            return _TRUNCATED # Never hand a known-bad answer to the cache
+        else:
+            # The stop sequence swallowed the closing fence, restore it
+            buf.write("\n" + _FENCE_CLOSE)
+    return buf.getvalue()
+
+def _cache_key(template, user_prompt):
+    # The payload prefix is part of the key so edited prompts don't serve stale code
+    h = template[2].copy()
+    h.update(user_prompt.encode("utf-8"))
+    return h.hexdigest()
+
+def _remember(key, response):
+    _memory_cache[key] = response
+    _memory_cache.move_to_end(key)
+    if len(_memory_cache) > _MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+
+def _disk_cache_get(key):
+    try:
+        with shelve.open(CACHE_PATH) as db:
+            return db.get(key)
+    except Exception:
+        return None
+
+def _disk_cache_put(key, response):
+    try:
+        with shelve.open(CACHE_PATH) as db:
+            db[key] = response
+    except Exception as e:
+        print(f"   (Debug: could not write response cache: {e})")
+
+def cached_call_deepseek(user_prompt, use_cache=True):
+    """call_deepseek_for_code with an in-memory LRU in front of a persistent shelve cache."""
+    template = select_payload_template(user_prompt)
+    key = _cache_key(template, user_prompt)
+    if use_cache:
+        response = _memory_cache.get(key)
+        if response is None:
+            response = _disk_cache_get(key)
+        if response is not None:
+            print("   ⚡ Using cached response")
+            _remember(key, response)
+            return response
+
+    response = call_deepseek_for_code(user_prompt, template)
+    if response:
+        store_cached_response(user_prompt, response)
+    return response
+
+def store_cached_response(user_prompt, response):
+    key = _cache_key(select_payload_template(user_prompt), user_prompt)
+    _remember(key, response)
+    _disk_cache_put(key, response)
+
+def evict_cached_response(user_prompt):
+    """Forget a rejected answer so the next run of the prompt asks DeepSeek again."""
+    key = _cache_key(select_payload_template(user_prompt), user_prompt)
+    _memory_cache.pop(key, None)
+    try:
+        with shelve.open(CACHE_PATH) as db:
+            db.pop(key, None)
+    except Exception as e:
+        print(f"   (Debug: could not update response cache: {e})")
+
+def request_code_repair(user_prompt, raw_response, error):
+    """Send the rejected answer back as a second turn so DeepSeek can fix it."""
+    followups = (
+        {"role": "assistant", "content": raw_response},
+        {"role": "user", "content": REPAIR_PROMPT.format(error=error)}
+    )
+    return call_deepseek_for_code(user_prompt, followups=followups)
+
+def find_fenced_code(text):
+    """Return the body of the first ```python fence, or None if it is not closed."""
+    start = text.find(_FENCE_OPEN)
+    if start == -1:
+        return None
+    start += len(_FENCE_OPEN)
+    end = text.find(_FENCE_CLOSE, start)
+    if end == -1:
+        return None
+    return text[start:end]
+
 def extract_python_code(text):
-    match = re.search(r"```python(.*?)```", text, re.DOTALL)
-    if match:
-        return match.group(1).strip()
+    body = find_fenced_code(text)
+    if body is not None:
+        return body.strip()
     # Fallback: maybe the whole text is code
-    if "hsf =" in text or "catia." in text:
+    if any(token in text for token in _FALLBACK_TOKENS):
         return text
     return None
 
 
+# --- CODE EXECUTION ---
+# (code object, executed source) keyed on the generated source, so re-running
+# a snippet skips parsing, rewriting and compilation.
+_CODE_CACHE = {}
+
+# part.Update() re-solves the whole feature tree, so N updates over N features
+# is O(N^2) kernel work. Intermediate updates are only kept when a following
+# step reads geometry: topology searches, selection items, measurements...
+_GEOMETRY_CONSUMERS = ("get_top_face", "CreateReferenceFromObject", "Search", "Item", "GetMeasurable")
+# An update deferred from the model's own code must still fail loudly; the
+# guarded form is only for scripts that never called part.Update() themselves.
+_DEFERRED_UPDATE = "part.Update()\n"
+_FINAL_UPDATE = (
+    "try:\n"
+    "    part.Update()\n"
+    "except Exception as e:\n"
+    "    print(f'   (Debug: final part.Update() failed: {e})')\n"
+)
+
+def _is_part_update(stmt):
+    return (isinstance(stmt, ast.Expr)
+            and isinstance(stmt.value, ast.Call)
+            and not stmt.value.args
+            and isinstance(stmt.value.func, ast.Attribute)
+            and stmt.value.func.attr == "Update"
+            and isinstance(stmt.value.func.value, ast.Name)
+            and stmt.value.func.value.id == "part")
+
+def _reads_new_geometry(stmt):
+    for node in ast.walk(stmt):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+        if name not in _GEOMETRY_CONSUMERS:
+            continue
+        # References to origin planes don't depend on an update
+        if name == "CreateReferenceFromObject" and node.args and "OriginElements" in ast.dump(node.args[0]):
+            continue
+        return True
+    return False
+
+# Best-effort filter for generated code: it only needs the injected CATIA
+# objects. It catches imports and the obvious escape hatches (builtins looked
+# up by name, dunder access, spawning other COM servers), but it is NOT a
+# sandbox: the confirmation prompt is still the real safety check.
+_ALLOWED_IMPORTS = ("math",) # Harmless, and already injected
+_FORBIDDEN_NAMES = ("__import__", "open", "eval", "exec", "compile", "getattr", "setattr",
+                    "delattr", "globals", "locals", "vars", "breakpoint")
+_FORBIDDEN_MODULES = ("os", "subprocess", "sys", "shutil")
+
+def _is_dunder(name):
+    return name.startswith("__") and name.endswith("__")
+
+def _root_name(node):
+    while isinstance(node, (ast.Attribute, ast.Call, ast.Subscript)):
+        node = node.func if isinstance(node, ast.Call) else node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+def find_unsafe_code(tree):
+    """Return a description of the first forbidden construct in `tree`, or None."""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import) and all(a.name in _ALLOWED_IMPORTS for a in node.names):
+            continue
+        if isinstance(node, ast.ImportFrom) and node.module in _ALLOWED_IMPORTS and not node.level:
+            continue
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            return f"import statements are not allowed (line {node.lineno})"
+        if isinstance(node, ast.Name) and (node.id in _FORBIDDEN_NAMES or _is_dunder(node.id)):
+            return f"use of {node.id} is not allowed (line {node.lineno})"
+        if isinstance(node, ast.Attribute) and _is_dunder(node.attr):
+            return f"access to .{node.attr} is not allowed (line {node.lineno})"
+        if (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name)
+                and node.value.id in _FORBIDDEN_MODULES):
+            return f"access to {node.value.id}.{node.attr} is not allowed (line {node.lineno})"
+        if isinstance(node, ast.Call) and _root_name(node.func) == "win32com":
+            return f"win32com calls are not allowed, use the injected `catia` (line {node.lineno})"
+    return None
+
+def batch_part_updates(tree):
+    """Drop top-level part.Update() calls no geometry read depends on, update once at the end.
+
+    Returns (tree, changed).
+    """
+    body = tree.body
+    kept = []
+    removed = 0
+    last_removed = None
+    for i, stmt in enumerate(body):
+        if _is_part_update(stmt):
+            needed = False
+            for later in body[i + 1:]:
+                if _is_part_update(later):
+                    break # A later update covers it
+                if _reads_new_geometry(later):
+                    needed = True
+                    break
+            else:
+                needed = i == len(body) - 1 # Already the final update
+            if not needed:
+                removed += 1
+                last_removed = stmt
+                continue
+        kept.append(stmt)
+    appended = not kept or not _is_part_update(kept[-1])
+    if appended:
+        final = ast.parse(_DEFERRED_UPDATE if removed else _FINAL_UPDATE).body
+        # Point tracebacks at the deferred update, or else the script's last line
+        anchor = last_removed or (kept[-1] if kept else None)
+        if anchor is not None:
+            for node in ast.walk(final[0]):
+                ast.copy_location(node, anchor)
+        kept.extend(final)
+    tree.body = kept
+    return ast.fix_missing_locations(tree), bool(removed or appended)
+
+def compile_generated_code(code):
+    """Return (code object, source that will actually run) for generated `code`."""
+    entry = _CODE_CACHE.get(code)
+    if entry is None:
+        tree = ast.parse(code, "<deepseek>")
+        problem = find_unsafe_code(tree)
+        if problem:
+            raise ValueError(problem)
+        tree, changed = batch_part_updates(tree)
+        source = ast.unparse(tree) if changed else code
+        entry = (compile(tree, "<deepseek>", "exec"), source)
+        _CODE_CACHE[code] = entry
+    return entry
+
+def validate_generated_code(code):
+    """Parse and compile up front (pure Python, fast); returns an error description or None."""
+    try:
+        compile_generated_code(code)
+    except SyntaxError as e:
+        return f"SyntaxError: {e.msg} (line {e.lineno})"
+    except ValueError as e:
+        return str(e)
+    return None
+
+
 # --- HELPER FUNCTIONS FOR AI (Injected) ---
+# Set by main() once connected, so helpers don't need to look CATIA up again.
+_CATIA = None
+
 def require_geoset(part, name):
     try:
         return part.HybridBodies.Item(name)
@@ -185,37 +581,144 @@ def require_body(part, name):
         body.Name = name
         return body
 
-def get_top_face(pad):
+def get_top_face(pad, catia=None):
     try:
         # Need to access the Selection object safely. 
         # In V6, it is on the ActiveEditor.
-        # Since 'catia' object might not be passed here, we grab it or use the global one if possible.
-        # Safest way: Grab active object.
-        catia = win32com.client.GetActiveObject("CATIA.Application")
+        # Prefer the handle from connect time; a ROT lookup costs several ms.
+        if catia is None:
+            catia = _CATIA
+        if catia is None:
+            catia = win32com.client.GetActiveObject("CATIA.Application")
         sel = catia.ActiveEditor.Selection
         
         part = pad.Parent.Parent
         sel.Clear()
         sel.Add(pad)
         sel.Search("Topology.Face.Planar,sel")
-        print(f"   (Debug: Found {sel.Count} planar faces on pad)")
+        count = sel.Count # One COM round-trip instead of one per use
+        print(f"   (Debug: Found {count} planar faces on pad)")
         
-        if sel.Count > 0:
-            # Return the last face (heuristic for Top)
-            ref = part.CreateReferenceFromObject(sel.Item(sel.Count).Value)
-            return ref
+        if count > 0:
+            # Return the last face (heuristic for Top). Only that face is
+            # marshalled; the selection is released before building the Reference.
+            face = sel.Item(count).Value
+            sel.Clear()
+            return part.CreateReferenceFromObject(face)
     except Exception as e:
         print(f"   (Debug: get_top_face error: {e})")
     return None
 
+# --- CATIA CONTEXT ---
+@dataclass
+class CatiaCtx:
+    """COM handles for the active part, fetched once and reused until the part changes."""
+    editor: object
+    part: object
+    hsf: object
+    sf: object
+    bodies: object
+    selection: object
+    part_id: object
+    exec_globals: Optional[dict] = None # Pre-assembled namespace for generated code
+
+def build_globals(catia, ctx):
+    exec_globals = {
+        "win32com": win32com,
+        "math": math,
+        "catia": catia,
+        # Inject Helpers
+        "require_geoset": require_geoset,
+        "require_body": require_body,
+        "get_top_face": functools.partial(get_top_face, catia=catia)
+    }
+    # Factories that could not be fetched are left out
+    exec_globals.update({
+        name: getattr(ctx, name)
+        for name in ("editor", "part", "selection", "hsf", "sf", "bodies")
+        if getattr(ctx, name) is not None
+    })
+    return exec_globals
+
+def _com_attr(obj, name):
+    try:
+        return getattr(obj, name)
+    except Exception:
+        return None
+
+def _part_identity(obj):
+    part_id = _com_attr(obj, "UUID")
+    if part_id is None:
+        part_id = _com_attr(obj, "Name")
+    return part_id
+
+def build_catia_ctx(catia, log=print):
+    editor = catia.ActiveEditor
+    active_obj = editor.ActiveObject
+    selection = editor.Selection
+
+    # Robust Part Detection:
+    real_part = active_obj
+    hsf = _com_attr(real_part, "HybridShapeFactory")
+    if hsf is None:
+        log("   (ActiveObject is not a Part, searching for 3D Part context...)")
+        try:
+            selection.Clear()
+            selection.Search("CATGmoSearch.Part,all")
+            if selection.Count > 0:
+                real_part = selection.Item(1).Value
+                hsf = _com_attr(real_part, "HybridShapeFactory")
+                log(f"   (Found Part: {real_part.Name})")
+        except:
+            pass
+
+    ctx = CatiaCtx(
+        editor=editor,
+        part=real_part,
+        hsf=hsf,
+        sf=_com_attr(real_part, "ShapeFactory"),
+        bodies=_com_attr(real_part, "Bodies"),
+        selection=selection,
+        part_id=_part_identity(active_obj)
+    )
+    ctx.exec_globals = build_globals(catia, ctx)
+    return ctx
+
+def refresh_catia_ctx(catia, ctx, log=print):
+    """Return `ctx` while the active object is unchanged, otherwise rebuild it.
+
+    Status messages go through `log`, so callers can defer them.
+    """
+    if ctx is not None and ctx.part_id is not None:
+        try:
+            # The Name fallback of part_id can't tell a reopened (or same-named)
+            # part apart, the editor can: pywin32 compares dispatches by IUnknown.
+            editor = catia.ActiveEditor
+            if editor == ctx.editor and _part_identity(editor.ActiveObject) == ctx.part_id:
+                return ctx
+        except Exception:
+            pass
+    return build_catia_ctx(catia, log)
+
+def connect_catia():
+    """Attach to the running CATIA session.
+
+    Deliberately late-bound: gencache/makepy wrappers type every result by its
+    declared interface (ActiveObject -> AnyObject, Selection.Item().Value ->
+    AnyObject, pad.Parent -> ...), which hides Part/Body members from both
+    the script and the generated code.
+    """
+    return win32com.client.GetActiveObject("CATIA.Application")
+
 def main():
+    global _CATIA
     print("="*50)
     print("CATIA GENERATIVE AGENT (Text-to-Geometry)")
     print("="*50)
     print("Initializing CATIA connection...")
     
     try:
-        catia = win32com.client.GetActiveObject("CATIA.Application")
+        catia = _CATIA = connect_catia()
         print("Connected to CATIA V6")
     except:
         print("Could not connect to CATIA (Is it running?)")
@@ -223,87 +726,102 @@ def main():
         print("\n[!] Check that CATIA 3DExperience is running and a Part is active.")
         return
 
+    if API_KEY != "YOUR_API_KEY_HERE":
+        start_keepalive()
+
+    ctx = None
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="deepseek")
+
     while True:
         print("\n" + "-"*30)
-        user_input = input("Enter Command (or 'q' to quit): ")
+        user_input = input(f"Enter Command ('{NOCACHE_PREFIX} ...' skips the cache, 'q' to quit): ")
         if user_input.lower() in ['q', 'exit']:
+            _stop_keepalive.set()
+            pool.shutdown(wait=False)
             break
             
         if API_KEY == "YOUR_API_KEY_HERE":
             print("❌ ERROR: Please edit the script and insert your valid DeepSeek API Key!")
             continue
 
-        # 1. GENERATE
-        raw_response = call_deepseek_for_code(user_input)
+        use_cache = True
+        if user_input.startswith(NOCACHE_PREFIX):
+            use_cache = False
+            user_input = user_input[len(NOCACHE_PREFIX):].strip()
+
+        # 1. GENERATE (network-bound, runs on the worker thread)
+        future = pool.submit(cached_call_deepseek, user_input, use_cache=use_cache)
+        # Meanwhile warm the CATIA handles here: COM objects belong to this thread.
+        # Its messages wait until streaming is done so they don't split the code.
+        ctx_messages = []
+        try:
+            ctx = refresh_catia_ctx(catia, ctx, log=ctx_messages.append)
+        except Exception:
+            ctx = None
+        try:
+            raw_response = future.result()
+        except KeyboardInterrupt:
+            # The worker is not a daemon: cut its HTTP read short instead of waiting for the timeout
+            _stop_keepalive.set()
+            abort_active_request()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        for message in ctx_messages:
+            print(message)
         if not raw_response: continue
         
         code = extract_python_code(raw_response)
         
         if not code:
+            evict_cached_response(user_input)
             print("⚠️ No valid code found in AI response.")
             print(f"Raw: {raw_response}")
             continue
+
+        # Reject broken/unsafe code before it reaches CATIA, let DeepSeek fix it once
+        error = validate_generated_code(code)
+        if error:
+            evict_cached_response(user_input)
+            print(f"⚠️ Generated code rejected: {error}")
+            print("   🔧 Asking DeepSeek to repair it...")
+            raw_response = request_code_repair(user_input, raw_response, error)
+            code = extract_python_code(raw_response) if raw_response else None
+            error = validate_generated_code(code) if code else "no code in repair response"
+            if error:
+                print(f"❌ Repair failed: {error}")
+                continue
+            store_cached_response(user_input, raw_response)
             
+        # Show what will really run (part.Update() calls may have been batched)
+        exec_source = compile_generated_code(code)[1]
         print("\nGENERATED CODE:")
-        print("\033[96m" + code + "\033[0m") 
+        print("\033[96m" + exec_source + "\033[0m") 
+        if exec_source != code:
+            print("   (part.Update() calls were batched, the code above is what will run)")
         
         # 2. VALIDATE 
         confirm = input("\nExecute this? (y/n): ")
         if confirm.lower() != 'y':
+            evict_cached_response(user_input) # Declined: don't replay it next time
             print("Cancelled.")
             continue
             
         # 3. EXECUTE
         print("Executing...")
         try:
-            # PRE-INJECT COMMON OBJECTS
-            editor = catia.ActiveEditor
-            active_obj = editor.ActiveObject
-            
-            # Robust Part Detection:
-            real_part = active_obj
-            try:
-                _ = real_part.HybridShapeFactory
-            except:
-                print("   (ActiveObject is not a Part, searching for 3D Part context...)")
-                try:
-                    sel = editor.Selection
-                    sel.Clear()
-                    sel.Search("CATGmoSearch.Part,all")
-                    if sel.Count > 0:
-                        real_part = sel.Item(1).Value
-                        print(f"   (Found Part: {real_part.Name})")
-                except:
-                    pass
-
-            exec_globals = {
-                "win32com": win32com,
-                "catia": catia,
-                "editor": editor,
-                "part": real_part,
-                "selection": editor.Selection,
-                # Inject Helpers
-                "require_geoset": require_geoset,
-                "require_body": require_body,
-                "get_top_face": get_top_face
-            }
-
-            # Safe injection of factories
-            try: exec_globals["hsf"] = real_part.HybridShapeFactory
-            except: pass
-            
-            try: exec_globals["sf"] = real_part.ShapeFactory
-            except: pass
-            
-            try: exec_globals["bodies"] = real_part.Bodies
-            except: pass
-            
-            exec(code, exec_globals)
+            # PRE-INJECT COMMON OBJECTS (cached until the active part changes)
+            ctx = refresh_catia_ctx(catia, ctx)
+            # Shallow copy so variables from one command don't leak into the next
+            exec(compile_generated_code(code)[0], dict(ctx.exec_globals))
             print("Success!")
             
         except Exception as e:
-            print("Execution Failed:")
-            traceback.print_exc()
+            ctx = None # Handles may be stale, rebuild on the next command
+            evict_cached_response(user_input) # Failed code must not be replayed
+            print(f"Execution Failed: {type(e).__name__}: {e}")
+            if DEBUG:
+                import traceback # Only needed for debugging, keep it off the startup path
+                traceback.print_exc()
 
 if __name__ == "__main__":
     main()